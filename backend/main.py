@@ -1,11 +1,37 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Tuple
+from typing import List, Literal, NamedTuple, Optional, Dict, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import math
-import networkx as nx
+import os
+import threading
+import numpy as np
 
-app = FastAPI()
+# Numba's on-disk kernel cache (cache=True) defaults to __pycache__ next to
+# this file, which a read-only install cannot write, so every process would
+# silently recompile. Keep it in a per-user directory unless NUMBA_CACHE_DIR
+# is set (e.g. to a persistent volume in a container).
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "hardy-cross", "numba"))
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:  # Numba is optional: fall back to running the kernels as plain Python
+    NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up_solver()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +46,31 @@ GRAVITY = 9.81  # m/s²
 PI = math.pi
 KINEMATIC_VISCOSITY = 1.0e-6  # m²/s (water at ~20°C)
 
+# Precomputed factors of the K and velocity formulas
+INV_PI2_G = 1.0 / (PI * PI * GRAVITY)  # 1 / (π²g)
+FOUR_OVER_PI = 4.0 / PI
+
+# Loop solver limits
+MAX_ITERATIONS = 500
+TOLERANCE = 1e-6  # Convergence tolerance for flow correction
+
+# Networks with at least this many loops compute loop corrections in parallel
+PARALLEL_LOOP_THRESHOLD = 64
+
+# With solver="auto", networks with at least this many loops use the global
+# Newton solver instead of per-loop Hardy Cross sweeps
+NEWTON_LOOP_THRESHOLD = 16
+
+# Without Numba, loops with more pipes than this are summed with NumPy
+VECTORIZE_LOOP_LENGTH = 32
+
+# Given puzzle values are taken as rounded to 2 decimals, so each may be off
+# by this much before the data counts as contradictory
+PUZZLE_ROUNDING = 0.005
+
+# Number of distinct pipe layouts (ids and end nodes) kept between requests
+TOPOLOGY_CACHE_SIZE = 16
+
 # --- ROBUST MODELS ---
 class PipeInput(BaseModel):
     id: str
@@ -47,48 +98,60 @@ class NetworkInput(BaseModel):
     pipes: List[PipeInput]
     nodes: List[NodeInput]
     fluid: Optional[FluidInput] = FluidInput()
+    include_history: Optional[bool] = False  # Return the per-iteration log (Hardy Cross only)
+    include_flow_history: Optional[bool] = False  # Add every pipe's flow to each logged iteration
+    # Loop solver: per-loop Hardy Cross sweeps, a global Newton step on all
+    # loops at once, or "auto" (Newton from NEWTON_LOOP_THRESHOLD loops up)
+    solver: Optional[Literal["auto", "hardy_cross", "newton"]] = "auto"
 
 # --- ROBUSTNESS CHECKS ---
 def validate_and_fix_network(nodes: List[NodeInput], pipes: List[PipeInput], method: str = "darcy") -> Tuple[List[NodeInput], List[PipeInput]]:
     """
     Validates and fixes the network data to ensure it's physically solvable.
+    
+    The input models are never modified: returns new lists in which only
+    the nodes and pipes that needed a fix are replaced by fixed copies.
     """
+    fixed_pipes = []
     for p in pipes:
+        fixes = {}
         if method == "darcy":
             # Defaults for simulation mode
-            if p.length is None or p.length <= 0: p.length = 1.0
-            if p.diameter is None or p.diameter <= 0: p.diameter = 1.0
-            if p.roughness is None or p.roughness <= 0: p.roughness = 0.02
+            if p.length is None or p.length <= 0: fixes["length"] = 1.0
+            if p.diameter is None or p.diameter <= 0: fixes["diameter"] = 1.0
+            if p.roughness is None or p.roughness <= 0: fixes["roughness"] = 0.02
         
         # Ensure ID exists
-        if not p.id: p.id = f"{p.start_node}-{p.end_node}"
+        if not p.id: fixes["id"] = f"{p.start_node}-{p.end_node}"
+        
+        fixed_pipes.append(p.model_copy(update=fixes) if fixes else p)
+    pipes = fixed_pipes
 
     # 2. CONTINUITY CHECK (Only for Darcy Mode where all demands must be known)
     if method == "darcy":
         # Fill missing demands with 0
-        for n in nodes:
-            if n.demand is None: n.demand = 0.0
+        nodes = [n.model_copy(update={"demand": 0.0}) if n.demand is None else n for n in nodes]
 
         total_demand = sum(n.demand for n in nodes)
         if abs(total_demand) > 1e-6:
-            # Balance the network
-            source_nodes = [n for n in nodes if n.demand > 0]
-            if source_nodes:
-                max_node = max(source_nodes, key=lambda n: n.demand)
-            elif nodes:
-                max_node = max(nodes, key=lambda n: abs(n.demand))
-            else:
-                return nodes, pipes # Empty nodes list
+            # Balance the network at the largest source, or at the largest
+            # |demand| if there is no source
+            demands = np.array([n.demand for n in nodes])
+            max_idx = int(np.argmax(demands if (demands > 0).any() else np.abs(demands)))
             
-            max_node.demand -= total_demand
+            max_node = nodes[max_idx]
+            nodes[max_idx] = max_node.model_copy(update={"demand": max_node.demand - total_demand})
             print(f"⚠️ Balanced network at node '{max_node.id}' by {-total_demand:.2f}")
+    else:
+        nodes = list(nodes)
 
     return nodes, pipes
 
 # --- DARCY-WEISBACH PHYSICS ---
-def calculate_resistance_coefficient(pipe: PipeInput) -> float:
+def resistance_coefficients(pipes: List[PipeInput]) -> np.ndarray:
     """
-    Get the resistance coefficient K for the Darcy-Weisbach equation.
+    Get the resistance coefficient K for the Darcy-Weisbach equation, for
+    every pipe as one array.
     
     If K is directly provided (resistance_k), use it.
     Otherwise, calculate from friction factor:
@@ -101,18 +164,19 @@ def calculate_resistance_coefficient(pipe: PipeInput) -> float:
     L = pipe length (m)
     D = pipe diameter (m)
     g = gravitational acceleration (m/s²)
-    """
-    # If K is directly provided, use it
-    if pipe.resistance_k is not None and pipe.resistance_k > 0:
-        return pipe.resistance_k
     
-    # Otherwise calculate from friction factor
-    f = pipe.roughness  # Darcy friction factor
-    L = pipe.length
-    D = pipe.diameter
+    The per-pipe attributes are gathered into arrays once and K is computed
+    with a single NumPy expression.
+    """
+    K_given = np.array([p.resistance_k for p in pipes], dtype=np.float64)  # None -> nan
+    f = np.array([p.roughness for p in pipes], dtype=np.float64)
+    L = np.array([p.length for p in pipes], dtype=np.float64)
+    D = np.array([p.diameter for p in pipes], dtype=np.float64)
     
-    K = (8.0 * f * L) / (PI**2 * GRAVITY * D**5)
-    return K
+    D2 = D * D
+    with np.errstate(divide="ignore", invalid="ignore"):
+        K = (8.0 * f * L * INV_PI2_G) / (D2 * D2 * D)
+    return np.where(K_given > 0, K_given, K)
 
 def get_k_source(pipe: PipeInput) -> str:
     """Returns whether K was provided directly or calculated."""
@@ -140,53 +204,100 @@ def calculate_head_loss_derivative(K: float, Q: float) -> float:
     """
     return 2.0 * K * (abs(Q) + 1e-10)
 
+def bfs_parents(adj: Dict[str, List[str]], source: str) -> Dict[str, Optional[str]]:
+    """
+    Breadth-first search from source over a dict-of-lists adjacency.
+    
+    Returns {node: parent} for every reachable node (the source maps to
+    None); following parents from a node gives a shortest path to source.
+    """
+    parents: Dict[str, Optional[str]] = {source: None}
+    queue = [source]
+    for u in queue:
+        for v in adj.get(u, ()):
+            if v not in parents:
+                parents[v] = u
+                queue.append(v)
+    return parents
+
 def initialize_flows_robust(nodes: List[NodeInput], pipes: List[PipeInput]) -> Dict[str, float]:
     """
     Initialize pipe flows using path-based flow distribution.
     
+    Returns a {pipe_id: flow} dict; see initialize_flows_array for the strategy.
+    """
+    pipe_ids = list(dict.fromkeys(p.id for p in pipes))
+    pid_to_idx = {p_id: i for i, p_id in enumerate(pipe_ids)}
+    flows = initialize_flows_array(nodes, pipes, pid_to_idx)
+    return dict(zip(pipe_ids, flows.tolist()))
+
+def initialize_flows_array(nodes: List[NodeInput], pipes: List[PipeInput],
+                           pid_to_idx: Dict[str, int]) -> np.ndarray:
+    """
+    Initialize pipe flows using path-based flow distribution.
+    
     Strategy:
-    1. Build a graph of the network
+    1. Build an adjacency list of the network
     2. Find shortest paths from sources (positive demand) to sinks (negative demand)
     3. Distribute flow along these paths proportionally
     
     Flow sign convention:
     - Positive flow: from start_node to end_node (as defined in pipe)
     - Negative flow: from end_node to start_node
+    
+    Returns a float64 array of flows indexed by pid_to_idx.
     """
-    G = nx.Graph()
-    pipe_flows: Dict[str, float] = {p.id: 0.0 for p in pipes}
+    pipe_flows = [0.0] * len(pid_to_idx)
     
-    # Map edges to pipe IDs for quick lookup
-    edge_to_pipe_id: Dict[Tuple[str, str], str] = {}
+    # Map directed edges to (pipe index, direction sign) for quick lookup:
+    # +1 when traversing start_node -> end_node, -1 when traversing against it
+    adj: Dict[str, List[str]] = {}
+    edge_to_pipe: Dict[Tuple[str, str], Tuple[int, float]] = {}
     for p in pipes:
-        G.add_edge(p.start_node, p.end_node, id=p.id)
-        edge_to_pipe_id[(p.start_node, p.end_node)] = p.id
-        edge_to_pipe_id[(p.end_node, p.start_node)] = p.id
-
-    # Create pipe lookup
-    pipe_map = {p.id: p for p in pipes}
+        adj.setdefault(p.start_node, []).append(p.end_node)
+        adj.setdefault(p.end_node, []).append(p.start_node)
+        pidx = pid_to_idx[p.id]
+        edge_to_pipe[(p.start_node, p.end_node)] = (pidx, 1.0)
+        edge_to_pipe[(p.end_node, p.start_node)] = (pidx, -1.0)
     
     # Identify sources (inflow, positive demand) and sinks (outflow, negative demand)
     node_demands = {n.id: n.demand for n in nodes}
+    # Both are sorted largest-first so the greedy matching below mostly
+    # drains whole sources into whole sinks: every transfer exhausts a
+    # source or satisfies a sink, so there are at most S + K - 1 of them
     sources = sorted(
         [n_id for n_id, d in node_demands.items() if d > 1e-9],
-        key=lambda x: node_demands[x],
+        key=node_demands.__getitem__,
         reverse=True
     )
     sinks = sorted(
         [n_id for n_id, d in node_demands.items() if d < -1e-9],
-        key=lambda x: node_demands[x]  # Most negative first
+        key=node_demands.__getitem__  # Most negative first
     )
     
     # Track remaining capacity at each node
     remaining_supply = {s: node_demands[s] for s in sources}
     remaining_demand = {s: -node_demands[s] for s in sinks}  # Convert to positive
 
+    # BFS parent maps, computed once per source and shared by every sink
+    # it feeds (instead of a fresh shortest-path search per source/sink pair)
+    source_parents: Dict[str, Dict[str, Optional[str]]] = {}
+
+    # Sources are drained largest-first, so exhausted ones form a prefix
+    # of `sources` that later sinks can skip
+    first_source = 0
+
     # Distribute flow from sources to sinks using shortest paths
     for sink_id in sinks:
+        while first_source < len(sources) and remaining_supply[sources[first_source]] <= 1e-9:
+            first_source += 1
+        if first_source == len(sources):
+            break  # All supply has been distributed
+        
         demand_needed = remaining_demand[sink_id]
         
-        for source_id in sources:
+        for k in range(first_source, len(sources)):
+            source_id = sources[k]
             if demand_needed <= 1e-9:
                 break
             
@@ -199,39 +310,635 @@ def initialize_flows_robust(nodes: List[NodeInput], pipes: List[PipeInput]) -> D
             if flow_amount <= 1e-9:
                 continue
 
-            try:
-                # Find shortest path from source to sink
-                path = nx.shortest_path(G, source_id, sink_id)
+            parents = source_parents.get(source_id)
+            if parents is None:
+                parents = source_parents[source_id] = bfs_parents(adj, source_id)
+
+            if sink_id not in parents:
+                print(f"⚠️ No path found from {source_id} to {sink_id}")
+                continue
+
+            # Walk the shortest path back from sink to source, applying flow
+            # in the source -> sink direction (sign relative to pipe definition)
+            node_v = sink_id
+            while node_v != source_id:
+                node_u = parents[node_v]
+                pidx, direction = edge_to_pipe[(node_u, node_v)]
+                pipe_flows[pidx] += flow_amount * direction
+                node_v = node_u
+            
+            # Update remaining capacities
+            remaining_supply[source_id] -= flow_amount
+            remaining_demand[sink_id] -= flow_amount
+            demand_needed -= flow_amount
+    
+    return np.array(pipe_flows, dtype=np.float64)
+
+def paton_cycle_basis(adj: Dict[str, Dict[str, str]]) -> List[List[str]]:
+    """
+    Cycle basis by Paton's algorithm, the same loops nx.cycle_basis returns.
+    
+    Walks a depth-first spanning tree of each component and closes one loop
+    per non-tree edge. Used by the puzzle solver, whose substitution order
+    depends on which loops it is given, and by the iterative solvers: any
+    basis is valid for them, but per-loop Hardy Cross needs short loops that
+    overlap little. A BFS spanning tree's fundamental cycles nest inside one
+    another and slow its sweeps down to hundreds of iterations.
+    """
+    unvisited = dict.fromkeys(adj)  # Ordered set of nodes
+    cycles = []
+    while unvisited:  # One pass per connected component
+        root = unvisited.popitem()[0]
+        stack = [root]
+        pred = {root: root}
+        used: Dict[str, set] = {root: set()}
+        while stack:
+            z = stack.pop()
+            zused = used[z]
+            for nbr in adj[z]:
+                if nbr not in used:  # New node, extend the tree
+                    pred[nbr] = z
+                    stack.append(nbr)
+                    used[nbr] = {z}
+                elif nbr == z:  # Self loop
+                    cycles.append([z])
+                elif nbr not in zused:  # Non-tree edge closes a loop
+                    pn = used[nbr]
+                    cycle = [nbr, z]
+                    p = pred[z]
+                    while p not in pn:
+                        cycle.append(p)
+                        p = pred[p]
+                    cycle.append(p)
+                    cycles.append(cycle)
+                    used[nbr].add(z)
+        for node in pred:
+            unvisited.pop(node, None)
+    return cycles
+
+def build_loop_arrays(adj: Dict[str, Dict[str, str]], loops: List[List[str]], pipes: List[PipeInput],
+                      pid_to_idx: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Flatten the loops (node sequences) into CSR arrays for the iteration kernel.
+    
+    Returns (loop_pipe_idx, loop_dir, loop_starts): the pipes of loop l are
+    loop_pipe_idx[loop_starts[l]:loop_starts[l + 1]], and loop_dir is +1 when
+    the loop traverses a pipe from start_node to end_node, -1 otherwise.
+    
+    This is done once per solve, so the iteration itself never touches the
+    graph or the pipe objects.
+    """
+    loop_pipe_idx = []
+    loop_dir = []
+    loop_starts = [0]
+    for loop_nodes in loops:
+        num_nodes = len(loop_nodes)
+        for i in range(num_nodes):
+            node_u = loop_nodes[i]
+            node_v = loop_nodes[(i + 1) % num_nodes]
+            
+            # Get pipe connecting these nodes
+            pid = adj[node_u].get(node_v)
+            if pid is None:
+                continue
+            
+            pidx = pid_to_idx[pid]
+            loop_pipe_idx.append(pidx)
+            loop_dir.append(1 if pipes[pidx].start_node == node_u else -1)
+        loop_starts.append(len(loop_pipe_idx))
+    
+    return (
+        np.array(loop_pipe_idx, dtype=np.int32),
+        np.array(loop_dir, dtype=np.int8),
+        np.array(loop_starts, dtype=np.int32),
+    )
+
+@njit(cache=True, fastmath=True)
+def loop_sums(K_arr, Q_arr, loop_pipe_idx, loop_dir, start, end):
+    """
+    Sum of head losses and of their derivatives around one loop.
+    
+    The loop's pipes are loop_pipe_idx[start:end]. Returns
+    (sum K·q·|q|, sum 2K·|q|) with q the flow in loop direction.
+    """
+    if not NUMBA_AVAILABLE and end - start > VECTORIZE_LOOP_LENGTH:
+        # Interpreted fallback: one NumPy reduction beats a Python loop
+        idx = loop_pipe_idx[start:end]
+        K = K_arr[idx]
+        q = Q_arr[idx] * loop_dir[start:end]
+        aq = np.abs(q)
+        return float(np.sum(K * q * aq)), float(np.sum(2.0 * K * (aq + 1e-10)))
+    
+    sum_head_loss = 0.0
+    sum_derivative = 0.0
+    for j in range(start, end):
+        pidx = loop_pipe_idx[j]
+        K = K_arr[pidx]
+        q = Q_arr[pidx] * loop_dir[j]
+        aq = abs(q)
+        sum_head_loss += K * q * aq
+        sum_derivative += 2.0 * K * (aq + 1e-10)
+    return sum_head_loss, sum_derivative
+
+# Explicit kernel signatures: Numba compiles eagerly at import (or loads the
+# on-disk cache) instead of on the first /solve request
+_KERNEL_RETURN = "Tuple((float64[::1], float64, int64))"
+_KERNEL_HISTORY_ARGS = "float64[:, ::1], float64[:, ::1], float64[:, ::1], float64[:, ::1], float64[::1]"
+
+@njit(
+    f"{_KERNEL_RETURN}(float64[::1], float64[::1], int32[::1], int8[::1], int32[::1], "
+    f"int64, float64, boolean, {_KERNEL_HISTORY_ARGS})",
+    cache=True, fastmath=True
+)
+def hardy_cross_iterate(K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts, max_iter, tol,
+                        record_history, hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max):
+    """
+    Compiled Hardy Cross iteration kernel.
+    
+    Loops are stored CSR-style: the pipes of loop l are
+    loop_pipe_idx[loop_starts[l]:loop_starts[l + 1]], traversed in the
+    direction loop_dir (+1 with the pipe definition, -1 against it).
+    
+    Each loop correction is applied immediately, so later loops in the same
+    iteration see the updated flows. Per-iteration values are written into
+    the preallocated hist_* buffers (row = iteration); with record_history
+    False every iteration reuses row 0 and hist_flows is never written, so
+    the buffers need only one row. hist_flows may also have no columns to
+    record the loop values without the flow snapshots.
+    
+    Returns (Q_arr, max_correction, iterations).
+    """
+    n_loops = loop_starts.shape[0] - 1
+    n_pipes = Q_arr.shape[0]
+    max_correction = 0.0
+    iterations = 0
+    
+    for it in range(max_iter):
+        iterations = it + 1
+        row = it if record_history else 0
+        max_correction = 0.0
+        if record_history and hist_flows.shape[1] > 0:
+            for p in range(n_pipes):
+                hist_flows[row, p] = Q_arr[p]
+        
+        for l in range(n_loops):
+            sum_head_loss, sum_derivative = loop_sums(
+                K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts[l], loop_starts[l + 1]
+            )
+            
+            if sum_derivative > 1e-12:
+                delta_Q = -sum_head_loss / sum_derivative
+            else:
+                delta_Q = 0.0
+            
+            if abs(delta_Q) > max_correction:
+                max_correction = abs(delta_Q)
+            
+            for j in range(loop_starts[l], loop_starts[l + 1]):
+                Q_arr[loop_pipe_idx[j]] += delta_Q * loop_dir[j]
+            
+            hist_sum_hl[row, l] = sum_head_loss
+            hist_sum_d[row, l] = sum_derivative
+            hist_delta[row, l] = delta_Q
+        
+        hist_max[row] = max_correction
+        if max_correction < tol:
+            break
+    
+    return Q_arr, max_correction, iterations
+
+def color_loops(loop_pipe_idx: np.ndarray, loop_starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Greedily group loops so that no two loops in a group share a pipe.
+    
+    Returns (loop_order, color_starts): the loops of group c are
+    loop_order[color_starts[c]:color_starts[c + 1]].
+    """
+    n_loops = len(loop_starts) - 1
+    pipe_loops: Dict[int, List[int]] = {}
+    for l in range(n_loops):
+        for pidx in loop_pipe_idx[loop_starts[l]:loop_starts[l + 1]].tolist():
+            pipe_loops.setdefault(pidx, []).append(l)
+    
+    loop_color = [-1] * n_loops
+    groups: List[List[int]] = []
+    for l in range(n_loops):
+        taken = set()
+        for pidx in loop_pipe_idx[loop_starts[l]:loop_starts[l + 1]].tolist():
+            for other in pipe_loops[pidx]:
+                taken.add(loop_color[other])
+        color = 0
+        while color in taken:
+            color += 1
+        loop_color[l] = color
+        if color == len(groups):
+            groups.append([])
+        groups[color].append(l)
+    
+    loop_order = [l for group in groups for l in group]
+    color_starts = [0]
+    for group in groups:
+        color_starts.append(color_starts[-1] + len(group))
+    return np.array(loop_order, dtype=np.int32), np.array(color_starts, dtype=np.int32)
+
+@njit(
+    f"{_KERNEL_RETURN}(float64[::1], float64[::1], int32[::1], int8[::1], int32[::1], "
+    f"int32[::1], int32[::1], int64, float64, boolean, {_KERNEL_HISTORY_ARGS})",
+    parallel=True, cache=True, fastmath=True
+)
+def hardy_cross_iterate_parallel(K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts,
+                                 loop_order, color_starts, max_iter, tol, record_history,
+                                 hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max):
+    """
+    Hardy Cross iteration kernel with loops corrected in parallel.
+    
+    Loops are processed group by group (see color_loops). Loops in the same
+    group share no pipes, so their corrections are independent and run in
+    parallel (prange) without racing on a pipe flow; groups still run one
+    after another so each group sees the corrections of the previous ones.
+    
+    Same history buffers and return value as hardy_cross_iterate.
+    """
+    n_loops = loop_starts.shape[0] - 1
+    n_colors = color_starts.shape[0] - 1
+    n_pipes = Q_arr.shape[0]
+    max_correction = 0.0
+    iterations = 0
+    
+    for it in range(max_iter):
+        iterations = it + 1
+        row = it if record_history else 0
+        if record_history and hist_flows.shape[1] > 0:
+            for p in range(n_pipes):
+                hist_flows[row, p] = Q_arr[p]
+        
+        for c in range(n_colors):
+            for k in prange(color_starts[c], color_starts[c + 1]):
+                l = loop_order[k]
+                sum_head_loss, sum_derivative = loop_sums(
+                    K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts[l], loop_starts[l + 1]
+                )
                 
-                # Apply flow along the path
-                for i in range(len(path) - 1):
-                    u, v = path[i], path[i + 1]
-                    pipe_id = edge_to_pipe_id[(u, v)]
-                    pipe_def = pipe_map[pipe_id]
-                    
-                    # Determine flow direction relative to pipe definition
-                    if pipe_def.start_node == u:
-                        # Flow direction matches pipe definition
-                        pipe_flows[pipe_id] += flow_amount
-                    else:
-                        # Flow direction opposite to pipe definition
-                        pipe_flows[pipe_id] -= flow_amount
+                if sum_derivative > 1e-12:
+                    delta_Q = -sum_head_loss / sum_derivative
+                else:
+                    delta_Q = 0.0
                 
-                # Update remaining capacities
-                remaining_supply[source_id] -= flow_amount
-                remaining_demand[sink_id] -= flow_amount
-                demand_needed -= flow_amount
+                for j in range(loop_starts[l], loop_starts[l + 1]):
+                    Q_arr[loop_pipe_idx[j]] += delta_Q * loop_dir[j]
                 
-            except nx.NetworkXNoPath:
-                print(f"⚠️ No path found from {source_id} to {sink_id}")
-                continue
+                hist_sum_hl[row, l] = sum_head_loss
+                hist_sum_d[row, l] = sum_derivative
+                hist_delta[row, l] = delta_Q
+        
+        max_correction = 0.0
+        for l in range(n_loops):
+            if abs(hist_delta[row, l]) > max_correction:
+                max_correction = abs(hist_delta[row, l])
+        
+        hist_max[row] = max_correction
+        if max_correction < tol:
+            break
+    
+    return Q_arr, max_correction, iterations
+
+def hardy_cross_iterate_numpy(K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts,
+                              loop_order, color_starts, max_iter, tol, record_history,
+                              hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max):
+    """
+    Vectorized NumPy version of hardy_cross_iterate_parallel.
+    
+    Used when Numba is not installed. Each group of pipe-disjoint loops is
+    corrected with a handful of array operations: the per-loop sums are
+    np.bincount reductions over the group's (pipe, direction, owner loop)
+    entries, and since no pipe appears twice in a group the corrections
+    are applied with one fancy-indexed add.
+    
+    The per-entry terms are written into scratch buffers allocated once per
+    group, so an iteration does not allocate a temporary for every step of
+    K·q·|q| and 2K·(|q| + eps).
+    
+    Same arguments and return value as hardy_cross_iterate_parallel.
+    """
+    # Flatten each group's loops once: pipe index, direction, position of
+    # the owning loop within the group, K, and scratch for q, |q|, h, dh/dq
+    groups = []
+    for c in range(len(color_starts) - 1):
+        group_loops = loop_order[color_starts[c]:color_starts[c + 1]]
+        lengths = loop_starts[group_loops + 1] - loop_starts[group_loops]
+        entries = np.concatenate(
+            [np.arange(loop_starts[l], loop_starts[l + 1]) for l in group_loops.tolist()]
+        )
+        pidx = loop_pipe_idx[entries]
+        groups.append((
+            group_loops,
+            pidx,
+            loop_dir[entries].astype(np.float64),
+            np.repeat(np.arange(len(group_loops)), lengths),
+            K_arr[pidx],
+            np.empty((4, len(pidx))),
+        ))
+    
+    max_correction = 0.0
+    iterations = 0
+    
+    for it in range(max_iter):
+        iterations = it + 1
+        row = it if record_history else 0
+        if record_history and hist_flows.shape[1] > 0:
+            hist_flows[row] = Q_arr
+        
+        for group_loops, pidx, sign, owner, K, (q, aq, hl, dh) in groups:
+            n = len(group_loops)
+            np.take(Q_arr, pidx, out=q)
+            q *= sign
+            np.abs(q, out=aq)
+            np.multiply(K, q, out=hl)
+            hl *= aq
+            np.add(aq, 1e-10, out=dh)
+            dh *= K
+            dh *= 2.0
+            sum_head_loss = np.bincount(owner, weights=hl, minlength=n)
+            sum_derivative = np.bincount(owner, weights=dh, minlength=n)
+            
+            solvable = sum_derivative > 1e-12
+            delta_Q = np.where(solvable, -sum_head_loss / np.where(solvable, sum_derivative, 1.0), 0.0)
+            Q_arr[pidx] += delta_Q[owner] * sign
+            
+            hist_sum_hl[row, group_loops] = sum_head_loss
+            hist_sum_d[row, group_loops] = sum_derivative
+            hist_delta[row, group_loops] = delta_Q
+        
+        max_correction = float(np.max(np.abs(hist_delta[row]))) if hist_delta.shape[1] else 0.0
+        hist_max[row] = max_correction
+        if max_correction < tol:
+            break
+    
+    return Q_arr, max_correction, iterations
+
+def loop_jacobian_pattern(loop_pipe_idx: np.ndarray, loop_dir: np.ndarray,
+                          loop_starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sparsity pattern of the loop Jacobian J = B·diag(w)·Bᵀ (see newton_iterate).
+    
+    J[l, m] sums dir_l·dir_m·w[p] over the pipes p shared by loops l and m,
+    so every pair of loop entries on the same pipe contributes one term.
+    Returns (flat_idx, pair_sign, pair_pipe) for those terms: J is then
+    np.bincount(flat_idx, weights=pair_sign * w[pair_pipe]) reshaped to
+    (n_loops, n_loops), without ever forming the loops x pipes matrix B.
+    """
+    n_loops = len(loop_starts) - 1
+    owner = np.repeat(np.arange(n_loops), np.diff(loop_starts))
+    
+    # Group the loop entries by pipe
+    order = np.argsort(loop_pipe_idx, kind="stable")
+    bounds = np.flatnonzero(np.diff(loop_pipe_idx[order])) + 1
+    group_starts = np.concatenate(([0], bounds))
+    group_sizes = np.diff(np.concatenate((group_starts, [len(order)])))
+    
+    # Pair every entry with every entry of its own group (itself included)
+    entry_group = np.repeat(np.arange(len(group_sizes)), group_sizes)
+    block = group_sizes[entry_group]
+    first = np.repeat(np.arange(len(order)), block)
+    offset = np.arange(block.sum()) - np.repeat(np.cumsum(block) - block, block)
+    second = np.repeat(group_starts[entry_group], block) + offset
+    e1 = order[first]
+    e2 = order[second]
+    
+    flat_idx = owner[e1] * n_loops + owner[e2]
+    pair_sign = (loop_dir[e1] * loop_dir[e2]).astype(np.float64)
+    return flat_idx, pair_sign, loop_pipe_idx[e1]
+
+def solve_newton_step(J: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Solve J·ΔQ = rhs for the Newton loop corrections.
+    
+    J is singular when some loops have no head loss derivative at all, e.g.
+    a loop of zero-resistance pipes. Hardy Cross skips such a loop (ΔQ = 0)
+    and carries on; here the least-squares solution does the same, leaving
+    the directions J cannot resolve uncorrected.
+    """
+    try:
+        delta_Q = np.linalg.solve(J, rhs)
+        if np.all(np.isfinite(delta_Q)):
+            return delta_Q
+    except np.linalg.LinAlgError:
+        pass
+    return np.linalg.lstsq(J, rhs, rcond=None)[0]
+
+def newton_iterate(K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts, max_iter, tol,
+                   record_history, hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max,
+                   jacobian_pattern=None):
+    """
+    Solve all loop equations together with Newton-Raphson.
+    
+    With B the loops x pipes incidence matrix (entries loop_dir), the loop
+    head losses are h = B·(K·Q·|Q|) and their Jacobian with respect to the
+    loop flow corrections is J = B·diag(2K·|Q|)·Bᵀ. Each iteration solves
+    J·ΔQ = -h and applies Q += Bᵀ·ΔQ, so every loop sees the effect of
+    its neighbours' corrections and convergence is quadratic rather than the
+    linear rate of per-loop Hardy Cross sweeps.
+    
+    B is never formed: the products with B are bincount reductions over the
+    loop CSR entries, and J is assembled from loop_jacobian_pattern, so an
+    iteration costs O(entries + pairs) rather than O(loops² · pipes). The
+    pattern depends on the loops alone; pass it in as jacobian_pattern to
+    reuse it across solves.
+    J itself is dense (fundamental loops overlap heavily) and symmetric
+    positive semi-definite, so it is solved with np.linalg.solve (see
+    solve_newton_step for the singular case). The history
+    buffers get h, diag(J) and ΔQ per loop, matching what Hardy Cross records.
+    
+    Same arguments and return value as hardy_cross_iterate.
+    """
+    n_loops = len(loop_starts) - 1
+    n_pipes = len(Q_arr)
+    owner = np.repeat(np.arange(n_loops), np.diff(loop_starts))
+    sign = loop_dir.astype(np.float64)
+    if jacobian_pattern is None:
+        jacobian_pattern = loop_jacobian_pattern(loop_pipe_idx, loop_dir, loop_starts)
+    flat_idx, pair_sign, pair_pipe = jacobian_pattern
+    
+    # Per-pipe scratch: |Q|, head loss, head loss derivative
+    aq = np.empty_like(Q_arr)
+    hl = np.empty_like(Q_arr)
+    dh = np.empty_like(Q_arr)
+    # Per-entry and per-pair scratch
+    entry_terms = np.empty(len(loop_pipe_idx))
+    pair_terms = np.empty(len(pair_pipe))
+    
+    max_correction = 0.0
+    iterations = 0
+    
+    for it in range(max_iter):
+        iterations = it + 1
+        row = it if record_history else 0
+        if record_history and hist_flows.shape[1] > 0:
+            hist_flows[row] = Q_arr
+        
+        np.abs(Q_arr, out=aq)
+        np.multiply(K_arr, Q_arr, out=hl)
+        hl *= aq
+        np.add(aq, 1e-10, out=dh)
+        dh *= K_arr
+        dh *= 2.0
+        
+        np.take(hl, loop_pipe_idx, out=entry_terms)
+        entry_terms *= sign
+        sum_head_loss = np.bincount(owner, weights=entry_terms, minlength=n_loops)
+        np.take(dh, pair_pipe, out=pair_terms)
+        pair_terms *= pair_sign
+        J = np.bincount(flat_idx, weights=pair_terms, minlength=n_loops * n_loops)
+        J = J.reshape(n_loops, n_loops)
+        if n_loops:
+            delta_Q = solve_newton_step(J, -sum_head_loss)
+        else:
+            delta_Q = np.zeros(0)
+        np.take(delta_Q, owner, out=entry_terms)
+        entry_terms *= sign
+        Q_arr += np.bincount(loop_pipe_idx, weights=entry_terms, minlength=n_pipes)
+        
+        hist_sum_hl[row] = sum_head_loss
+        hist_sum_d[row] = np.diag(J)
+        hist_delta[row] = delta_Q
+        
+        max_correction = float(np.max(np.abs(delta_Q))) if n_loops else 0.0
+        hist_max[row] = max_correction
+        if max_correction < tol:
+            break
+    
+    return Q_arr, max_correction, iterations
+
+def newton_iterate_batch(K_batch, Q_batch, loop_pipe_idx, loop_dir, loop_starts, max_iter, tol,
+                         jacobian_pattern=None):
+    """
+    newton_iterate for several scenarios of one network at once.
+    
+    Row s of K_batch / Q_batch holds the resistances / flows of scenario s.
+    Every iteration assembles the residuals and Jacobians of all scenarios
+    still iterating with one bincount each (the loop entries and Jacobian
+    pattern are shared, offset per scenario) and solves them with a single
+    stacked np.linalg.solve (one at a time when some J is singular, see
+    solve_newton_step). Each scenario stops updating once its own
+    correction is below tol, and gets the same result a separate
+    newton_iterate call would. No history is recorded. Memory grows with
+    scenarios x Jacobian pattern pairs.
+    
+    Returns (Q_batch, max_correction, iterations) with one entry per scenario.
+    """
+    n_batch, n_pipes = Q_batch.shape
+    n_loops = len(loop_starts) - 1
+    max_correction = np.zeros(n_batch)
+    iterations = np.zeros(n_batch, dtype=np.int64)
+    if n_loops == 0:
+        # Tree network: the initial flows already satisfy continuity
+        return Q_batch, max_correction, iterations
+    
+    owner = np.repeat(np.arange(n_loops), np.diff(loop_starts))
+    sign = loop_dir.astype(np.float64)
+    if jacobian_pattern is None:
+        jacobian_pattern = loop_jacobian_pattern(loop_pipe_idx, loop_dir, loop_starts)
+    flat_idx, pair_sign, pair_pipe = jacobian_pattern
+    
+    # bincount bins with a block per scenario; the scenarios still iterating
+    # are packed into the first rows, which use the first blocks
+    offsets = np.arange(n_batch)[:, None]
+    entry_bins = offsets * n_loops + owner
+    pair_bins = offsets * (n_loops * n_loops) + flat_idx
+    pipe_bins = offsets * n_pipes + loop_pipe_idx
+    
+    active = np.arange(n_batch)
+    for it in range(max_iter):
+        n_active = len(active)
+        Q = Q_batch[active]
+        K = K_batch[active]
+        
+        aq = np.abs(Q)
+        hl = K * Q
+        hl *= aq
+        dh = aq + 1e-10
+        dh *= K
+        dh *= 2.0
+        
+        sum_head_loss = np.bincount(
+            entry_bins[:n_active].ravel(),
+            weights=(np.take(hl, loop_pipe_idx, axis=1) * sign).ravel(),
+            minlength=n_active * n_loops
+        ).reshape(n_active, n_loops)
+        J = np.bincount(
+            pair_bins[:n_active].ravel(),
+            weights=(np.take(dh, pair_pipe, axis=1) * pair_sign).ravel(),
+            minlength=n_active * n_loops * n_loops
+        ).reshape(n_active, n_loops, n_loops)
+        rhs = -sum_head_loss
+        try:
+            delta_Q = np.linalg.solve(J, rhs[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta_Q = None
+        if delta_Q is None or not np.all(np.isfinite(delta_Q)):
+            # A singular J in one scenario fails the whole stacked solve:
+            # solve them one at a time instead, as newton_iterate would
+            delta_Q = np.stack([solve_newton_step(J[s], rhs[s]) for s in range(n_active)])
+        Q += np.bincount(
+            pipe_bins[:n_active].ravel(),
+            weights=(np.take(delta_Q, owner, axis=1) * sign).ravel(),
+            minlength=n_active * n_pipes
+        ).reshape(n_active, n_pipes)
+        Q_batch[active] = Q
+        
+        correction = np.max(np.abs(delta_Q), axis=1)
+        max_correction[active] = correction
+        iterations[active] = it + 1
+        active = active[correction >= tol]
+        if not len(active):
+            break
     
-    return pipe_flows
+    return Q_batch, max_correction, iterations
+
+def solve_determined_unknowns(rows: List[Dict[int, float]], rhs: List[float], n_unknowns: int,
+                              allowance: Optional[List[float]] = None) -> Optional[Dict[int, float]]:
+    """
+    Solve a linear system for the unknowns it determines.
+    
+    Equation i is sum(coeff * x[col] for col, coeff in rows[i].items()) == rhs[i].
+    The system may be under-determined: returns {col: value} for every
+    unknown that has the same value in all solutions (its column is not
+    touched by the null space). Returns None when the equations contradict
+    each other: the least-squares x misses them by more than the mismatch
+    allowed per equation (allowance; by default 1e-9 relative to the
+    largest right-hand side), measured as a vector norm. Equations without
+    unknowns (empty rows) only take part in that check.
+    """
+    if not rows:
+        return {}
+    
+    A = np.zeros((len(rows), n_unknowns))
+    for i, row in enumerate(rows):
+        for col, coeff in row.items():
+            A[i, col] = coeff
+    b = np.array(rhs)
+    
+    if n_unknowns:
+        x, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+    else:
+        x, rank = np.zeros(0), 0
+    if allowance is None:
+        allowance = np.full(len(b), 1e-9 * max(1.0, float(np.max(np.abs(b)))))
+    if np.linalg.norm(A @ x - b) > np.linalg.norm(allowance):
+        return None
+    if not n_unknowns:
+        return {}
+    
+    # Rows rank.. of Vt span the null space
+    null_space = np.linalg.svd(A)[2][rank:]
+    determined = np.all(np.abs(null_space) < 1e-9, axis=0)
+    return {j: float(x[j]) for j in np.flatnonzero(determined).tolist()}
 
 def solve_puzzle_network(nodes, pipes):
     """
     Solves for missing Pipe Q, Pipe hf, AND Node Demands using Mass/Energy Balance.
-    Non-iterative, logic-based solver.
+    Non-iterative: the balance equations are solved as linear systems, with
+    a logic-based substitution pass for data the linear systems reject.
     """
     # 1. Setup State
     solved_flows = {} # pipe_id -> float
@@ -246,21 +953,106 @@ def solve_puzzle_network(nodes, pipes):
     for n in nodes:
         if n.demand is not None: solved_demands[n.id] = n.demand
 
-    # Build Graph Helper
+    # Build Graph Helpers: pipe connections per node, and node -> {neighbour: pipe id}
+    # for cycle detection
     adj = {n.id: [] for n in nodes}
+    nbrs: Dict[str, Dict[str, str]] = {}
     for p in pipes:
         adj[p.start_node].append({"pid": p.id, "dir": 1})  # Leaving start (Out)
         adj[p.end_node].append({"pid": p.id, "dir": -1})   # Entering end (In)
+        nbrs.setdefault(p.start_node, {})[p.end_node] = p.id
+        nbrs.setdefault(p.end_node, {})[p.start_node] = p.id
+
+    # Directed edge -> (pipe, direction in loop), first matching pipe wins
+    edge_to_pipe = {}
+    for p in pipes:
+        edge_to_pipe.setdefault((p.start_node, p.end_node), (p, 1))
+        edge_to_pipe.setdefault((p.end_node, p.start_node), (p, -1))
 
     # Cycle Detection for Head Loss
-    G = nx.Graph()
-    for p in pipes: G.add_edge(p.start_node, p.end_node, id=p.id)
-    try:
-        loops = nx.cycle_basis(G)
-    except:
-        loops = []
+    loops = paton_cycle_basis(nbrs)
 
-    # 2. LOGIC LOOP (Repeat until no new values found)
+    # 2. LINEAR SOLVE
+    # Mass balance is linear in the unknown flows and demands, and once the
+    # flow directions are known the loop balance is linear in the unknown
+    # head losses. Solve both systems directly for whatever they determine;
+    # a system no values can satisfy means the given data contradicts itself
+    # (beyond the rounding of the given values, PUZZLE_ROUNDING each).
+    
+    # A. Mass balance: Sum(Q_in) - Sum(Q_out) + Demand = 0 at every node
+    col_of: Dict[Tuple[str, str], int] = {}  # ("flow", pipe id) / ("demand", node id) -> column
+    rows = []
+    mass_rhs = []
+    allowance = []
+    for node in nodes:
+        row: Dict[int, float] = {}
+        known = 0.0
+        n_given = 0
+        for c in adj[node.id]:
+            if c['pid'] in solved_flows:
+                known -= c['dir'] * solved_flows[c['pid']]
+                n_given += 1
+            else:
+                col = col_of.setdefault(("flow", c['pid']), len(col_of))
+                row[col] = row.get(col, 0.0) - c['dir']
+        if node.id in solved_demands:
+            known += solved_demands[node.id]
+            n_given += 1
+        else:
+            row[col_of.setdefault(("demand", node.id), len(col_of))] = 1.0
+        rows.append(row)
+        mass_rhs.append(-known)
+        allowance.append(PUZZLE_ROUNDING * n_given)
+    
+    solution = solve_determined_unknowns(rows, mass_rhs, len(col_of), allowance)
+    if solution is None:
+        return {"error": "Puzzle data is inconsistent: the given flows and demands do not satisfy mass balance."}
+    if solution:
+        unknowns = list(col_of)
+        for col, value in solution.items():
+            kind, key = unknowns[col]
+            (solved_flows if kind == "flow" else solved_demands)[key] = value
+    
+    # B. Loop balance: Sum(hf_signed * dir_in_loop) = 0, hf_signed = |hf| * sign(Q)
+    col_of_pipe: Dict[str, int] = {}
+    rows = []
+    loop_rhs = []
+    allowance = []
+    for loop in loops:
+        row = {}
+        known = 0.0
+        n_given = 0
+        for i in range(len(loop)):
+            entry = edge_to_pipe.get((loop[i], loop[(i + 1) % len(loop)]))
+            if entry is None:
+                break
+            p_found, p_dir = entry
+            pid = p_found.id
+            if pid in solved_hl:
+                if pid not in solved_flows:
+                    break  # Known |hf| but unknown direction
+                known += abs(solved_hl[pid]) * (1 if solved_flows[pid] >= 0 else -1) * p_dir
+                n_given += 1
+            else:
+                col = col_of_pipe.setdefault(pid, len(col_of_pipe))
+                row[col] = row.get(col, 0.0) + p_dir
+        else:
+            rows.append(row)
+            loop_rhs.append(-known)
+            allowance.append(PUZZLE_ROUNDING * n_given)
+    
+    solution = solve_determined_unknowns(rows, loop_rhs, len(col_of_pipe), allowance)
+    if solution is None:
+        return {"error": "Puzzle data is inconsistent: the given head losses do not satisfy loop balance."}
+    if solution:
+        unknown_pipes = list(col_of_pipe)
+        for col, hf_signed in solution.items():
+            pid = unknown_pipes[col]
+            # The magnitude needs a flow direction (and some flow) to be meaningful
+            if pid in solved_flows and abs(solved_flows[pid]) > 1e-9:
+                solved_hl[pid] = abs(hf_signed)
+
+    # 3. LOGIC LOOP (Repeat until no new values found)
     changed = True
     iterations = 0
     max_iter = len(pipes) * 2 + 5
@@ -331,16 +1123,10 @@ def solve_puzzle_network(nodes, pipes):
                 u, v = loop[i], loop[(i+1)%len(loop)]
                 
                 # Find connecting pipe
-                p_found = None
-                p_dir = 0
-                for p in pipes:
-                    if p.start_node == u and p.end_node == v:
-                        p_found = p; p_dir = 1; break
-                    if p.start_node == v and p.end_node == u:
-                        p_found = p; p_dir = -1; break
-                
-                if not p_found: 
+                entry = edge_to_pipe.get((u, v))
+                if entry is None:
                     valid_loop = False; break
+                p_found, p_dir = entry
                 
                 pid = p_found.id
                 
@@ -394,7 +1180,7 @@ def solve_puzzle_network(nodes, pipes):
                         solved_hl[pid_unk] = abs(calc_mag)
                         changed = True
 
-    # 3. Format Output
+    # 4. Format Output
     pipe_results = []
     for p in pipes:
         q = solved_flows.get(p.id, None)
@@ -433,197 +1219,399 @@ def solve_puzzle_network(nodes, pipes):
         "history": []
     }
 
+# --- TOPOLOGY CACHE ---
+class NetworkTopology(NamedTuple):
+    """Everything the solver derives from the pipe layout (ids and end nodes) alone."""
+    pid_to_idx: Dict[str, int]   # pipe id -> position in the per-pipe arrays
+    connected: bool
+    loops: List[List[str]]       # independent loops as node sequences
+    loop_pipe_idx: np.ndarray    # loop CSR arrays, see build_loop_arrays
+    loop_dir: np.ndarray
+    loop_starts: np.ndarray
+    loop_order: Optional[np.ndarray]   # loop groups for the parallel kernel,
+    color_starts: Optional[np.ndarray]  # see color_loops (large networks only)
+    # Newton Jacobian terms, see loop_jacobian_pattern (NEWTON_LOOP_THRESHOLD loops up)
+    jacobian_pattern: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+_topology_cache: "OrderedDict[tuple, NetworkTopology]" = OrderedDict()
+_topology_lock = threading.Lock()
+
+def build_network_topology(pipes: List[PipeInput]) -> NetworkTopology:
+    """
+    Build the graph, pipe index map and loop arrays for a list of pipes.
+    
+    Pipes get positions in the per-pipe arrays via pid_to_idx; a repeated
+    pipe id keeps its first position but the last definition.
+    
+    The graph is a plain node -> {neighbour: pipe id} dict rather than an
+    nx.Graph: the setup only needs adjacency and one edge lookup, and
+    building networkx's attribute dicts cost more than the traversal itself.
+    As with nx.Graph, parallel pipes collapse into one edge (the last pipe
+    wins).
+    """
+    adj: Dict[str, Dict[str, str]] = {}
+    pid_to_idx: Dict[str, int] = {}
+    pipe_list: List[PipeInput] = []
+    
+    for p in pipes:
+        adj.setdefault(p.start_node, {})[p.end_node] = p.id
+        adj.setdefault(p.end_node, {})[p.start_node] = p.id
+        i = pid_to_idx.setdefault(p.id, len(pipe_list))
+        if i == len(pipe_list):
+            pipe_list.append(p)
+        pipe_list[i] = p
+    
+    connected = bool(adj) and len(bfs_parents(adj, next(iter(adj)))) == len(adj)
+    loops = paton_cycle_basis(adj) if connected else []
+    loop_pipe_idx, loop_dir, loop_starts = build_loop_arrays(adj, loops, pipe_list, pid_to_idx)
+    
+    loop_order = color_starts = None
+    if len(loops) >= PARALLEL_LOOP_THRESHOLD:
+        loop_order, color_starts = color_loops(loop_pipe_idx, loop_starts)
+        if len(color_starts) - 1 == len(loops):
+            # Every group is a single loop: nothing to run in parallel
+            loop_order = color_starts = None
+    
+    jacobian_pattern = None
+    if len(loops) >= NEWTON_LOOP_THRESHOLD:
+        jacobian_pattern = loop_jacobian_pattern(loop_pipe_idx, loop_dir, loop_starts)
+    
+    return NetworkTopology(
+        pid_to_idx=pid_to_idx,
+        connected=connected,
+        loops=loops,
+        loop_pipe_idx=loop_pipe_idx,
+        loop_dir=loop_dir,
+        loop_starts=loop_starts,
+        loop_order=loop_order,
+        color_starts=color_starts,
+        jacobian_pattern=jacobian_pattern,
+    )
+
+def topology_key(pipes: List[PipeInput]) -> tuple:
+    """The pipe layout (ids and end nodes) that a NetworkTopology depends on."""
+    return tuple((p.id, p.start_node, p.end_node) for p in pipes)
+
+def get_network_topology(pipes: List[PipeInput]) -> NetworkTopology:
+    """
+    Return the topology for these pipes, reusing it across requests.
+    
+    Keyed on pipe ids and end nodes only, so edits to demands or pipe
+    properties (length, diameter, roughness, K) still hit the cache; only a
+    change to the layout builds a fresh one. Cached entries are shared and
+    must not be modified. Keeps the TOPOLOGY_CACHE_SIZE most recently used
+    layouts (see topology_key).
+    
+    Safe to call from several worker threads: the cache is only touched
+    under a lock, while the (slow) build runs outside it.
+    """
+    key = topology_key(pipes)
+    with _topology_lock:
+        topology = _topology_cache.get(key)
+        if topology is not None:
+            _topology_cache.move_to_end(key)
+            return topology
+    
+    topology = build_network_topology(pipes)
+    with _topology_lock:
+        _topology_cache[key] = topology
+        if len(_topology_cache) > TOPOLOGY_CACHE_SIZE:
+            _topology_cache.popitem(last=False)
+    return topology
+
+def loop_solver(data: NetworkInput, n_loops: int) -> str:
+    """The loop solver a request runs: "hardy_cross" or "newton"."""
+    solver = data.solver or "auto"
+    if solver == "auto":
+        # Small networks keep the classic per-loop Hardy Cross sweeps
+        solver = "newton" if n_loops >= NEWTON_LOOP_THRESHOLD else "hardy_cross"
+    return solver
+
 def solve_network(data: NetworkInput):
     """
     Solve the pipe network using the Hardy Cross iterative method.
     """
     # 1. VALIDATION & DATA PREPARATION
     # Pass 'method' to let validation know if it should be strict
-    nodes, pipes = validate_and_fix_network(data.nodes.copy(), data.pipes.copy(), method=data.method)
-    pipes_map = {p.id: p for p in pipes}
+    nodes, pipes = validate_and_fix_network(data.nodes, data.pipes, method=data.method)
 
     if data.method == "puzzle":
         return solve_puzzle_network(nodes, pipes)
 
-    # 2. BUILD NETWORK GRAPH & DETECT LOOPS
-    G = nx.Graph()
-    for p in pipes:
-        G.add_edge(p.start_node, p.end_node, id=p.id)
+    # 2. NETWORK GRAPH, LOOPS & PIPE ARRAYS
+    # The graph and loops depend only on the pipe layout, so repeated solves
+    # of the same network (e.g. after editing a demand) reuse them
+    topology = get_network_topology(pipes)
+    pid_to_idx = topology.pid_to_idx
+    pipe_ids = list(pid_to_idx)
+    loops = topology.loops
     
     # Check connectivity
-    if not nx.is_connected(G):
+    if not topology.connected:
         return {"error": "Network is not fully connected. Check pipe definitions."}
     
-    # Find independent loops (cycle basis)
-    try:
-        loops = nx.cycle_basis(G)
-        print(f"📊 Found {len(loops)} independent loop(s)")
-    except Exception as e:
-        return {"error": f"Could not find valid loops: {str(e)}"}
+    print(f"📊 Found {len(loops)} independent loop(s)")
 
     if not loops:
         # No loops = tree network, flow is determined by continuity alone
         print("ℹ️ No loops detected - network is a tree (branching) system")
 
+    pipe_list, K_arr, diam_arr = build_pipe_arrays(pipes, pid_to_idx)
+
+    # Use fluid properties from input or defaults
+    nu = data.fluid.viscosity if data.fluid else KINEMATIC_VISCOSITY
+
     # 3. INITIALIZE FLOWS
+    Q_arr = initial_flow_array(nodes, pipes, pipe_list, pid_to_idx)
+    
+    if not loops:
+        # Tree network: the initial flows already satisfy continuity, so
+        # there is nothing to iterate. Report it as one pass without loops,
+        # as the tutorial expects at least one history entry.
+        history = []
+        if data.include_history:
+            entry = {"iteration": 1, "loops": [], "max_correction": 0.0}
+            if data.include_flow_history:
+                entry["pipe_flows"] = {p_id: round(q, 6) for p_id, q in zip(pipe_ids, Q_arr.tolist())}
+            history.append(entry)
+        return {
+            "converged": True,
+            "iterations": 1,
+            "results": build_pipe_results(pipe_ids, pipe_list, K_arr, diam_arr, Q_arr, nu),
+            "history": history
+        }
+    
+    # 4. HARDY CROSS ITERATION
+    loop_pipe_idx = topology.loop_pipe_idx
+    loop_dir = topology.loop_dir
+    loop_starts = topology.loop_starts
+    
+    # Preallocated iteration history buffers (row = iteration). Without
+    # history the kernel overwrites a single row each iteration; the
+    # per-iteration copy of the flows is only made when asked for.
+    record_history = bool(data.include_history)
+    record_flows = record_history and bool(data.include_flow_history)
+    history_rows = MAX_ITERATIONS if record_history else 1
+    hist_flows = np.zeros((history_rows, len(pipe_ids) if record_flows else 0))
+    hist_sum_hl = np.zeros((history_rows, len(loops)))
+    hist_sum_d = np.zeros((history_rows, len(loops)))
+    hist_delta = np.zeros((history_rows, len(loops)))
+    hist_max = np.zeros(history_rows)
+    
+    if loop_solver(data, len(loops)) == "newton":
+        Q_arr, max_correction, num_iterations = newton_iterate(
+            K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts, MAX_ITERATIONS, TOLERANCE,
+            record_history, hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max,
+            jacobian_pattern=topology.jacobian_pattern
+        )
+    elif topology.loop_order is not None:
+        # Large networks: correct pipe-disjoint loops in parallel, or as
+        # NumPy array operations when Numba is not available
+        iterate = hardy_cross_iterate_parallel if NUMBA_AVAILABLE else hardy_cross_iterate_numpy
+        Q_arr, max_correction, num_iterations = iterate(
+            K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts,
+            topology.loop_order, topology.color_starts,
+            MAX_ITERATIONS, TOLERANCE, record_history,
+            hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max
+        )
+    else:
+        Q_arr, max_correction, num_iterations = hardy_cross_iterate(
+            K_arr, Q_arr, loop_pipe_idx, loop_dir, loop_starts, MAX_ITERATIONS, TOLERANCE,
+            record_history, hist_flows, hist_sum_hl, hist_sum_d, hist_delta, hist_max
+        )
+    converged = max_correction < TOLERANCE
+    
+    history = []
+    for it in range(num_iterations if record_history else 0):
+        sum_hl_row = hist_sum_hl[it].tolist()
+        sum_d_row = hist_sum_d[it].tolist()
+        delta_row = hist_delta[it].tolist()
+        entry = {
+            "iteration": it + 1,
+            "loops": [
+                {
+                    "loop_index": loop_idx + 1,
+                    "nodes": loop_nodes,
+                    "sum_head_loss": round(sum_hl_row[loop_idx], 6),
+                    "sum_derivative": round(sum_d_row[loop_idx], 6),
+                    "delta_Q": round(delta_row[loop_idx], 6)
+                }
+                for loop_idx, loop_nodes in enumerate(loops)
+            ],
+            "max_correction": round(float(hist_max[it]), 8)
+        }
+        if record_flows:
+            entry["pipe_flows"] = {p_id: round(q, 6) for p_id, q in zip(pipe_ids, hist_flows[it].tolist())}
+        history.append(entry)
+    
+    if converged:
+        print(f"✅ Converged after {num_iterations} iterations (max ΔQ = {max_correction:.2e})")
+    else:
+        print(f"⚠️ Did not converge after {MAX_ITERATIONS} iterations (max ΔQ = {max_correction:.2e})")
+
+    # 5. COMPUTE FINAL RESULTS
+    results = build_pipe_results(pipe_ids, pipe_list, K_arr, diam_arr, Q_arr, nu)
+
+    return {
+        "converged": converged,
+        "iterations": num_iterations,
+        "results": results,
+        "history": history
+    }
+
+def build_pipe_arrays(pipes: List[PipeInput],
+                      pid_to_idx: Dict[str, int]) -> Tuple[List[PipeInput], np.ndarray, np.ndarray]:
+    """
+    Order the pipes by pid_to_idx and gather their K and diameter arrays.
+    
+    A repeated pipe id keeps its first position but the last definition.
+    Returns (pipe_list, K_arr, diam_arr), all indexed by pipe position.
+    """
+    pipe_list: List[PipeInput] = [None] * len(pid_to_idx)
+    for p in pipes:
+        pipe_list[pid_to_idx[p.id]] = p
+    
+    # Per-pipe parallel arrays (struct-of-arrays), indexed by pipe position
+    K_arr = resistance_coefficients(pipe_list)
+    diam_arr = np.array([p.diameter for p in pipe_list], dtype=np.float64)
+    return pipe_list, K_arr, diam_arr
+
+def initial_flow_array(nodes: List[NodeInput], pipes: List[PipeInput],
+                       pipe_list: List[PipeInput], pid_to_idx: Dict[str, int]) -> np.ndarray:
+    """
+    Starting flows for the loop solvers, indexed by pipe position.
+    """
     # Check if we have suggested flows for all pipes (Validation Mode / Type 3)
     # We use them as initial guesses if provided.
     has_initial_flows = len(pipes) > 0 and all(p.given_flow is not None for p in pipes)
     
     if has_initial_flows:
         print("ℹ️ Using user-provided suggested discharges as initial guesses")
-        pipe_flows = {p.id: float(p.given_flow) for p in pipes}
-    else:
-        # Standard initialization satisfying continuity
-        pipe_flows = initialize_flows_robust(nodes, pipes)
+        return np.array([p.given_flow for p in pipe_list], dtype=np.float64)
     
-    # Calculate resistance coefficients for all pipes
-    pipe_K = {p.id: calculate_resistance_coefficient(p) for p in pipes}
+    # Standard initialization satisfying continuity
+    return initialize_flows_array(nodes, pipes, pid_to_idx)
+
+def build_pipe_results(pipe_ids: List[str], pipe_list: List[PipeInput], K_arr: np.ndarray,
+                       diam_arr: np.ndarray, Q_arr: np.ndarray, nu: float) -> List[dict]:
+    """
+    Per-pipe result rows (flow, velocity, head loss, Reynolds number, K) for solved flows.
+    """
+    # Velocity: V = Q / A = 4Q / (πD²)
+    velocity_arr = (FOUR_OVER_PI * np.abs(Q_arr)) / (diam_arr * diam_arr)
     
-    # 4. HARDY CROSS ITERATION
-    MAX_ITERATIONS = 500
-    TOLERANCE = 1e-6  # Convergence tolerance for flow correction
+    # Head loss (absolute value for magnitude)
+    head_loss_arr = np.abs(calculate_head_loss(K_arr, Q_arr))
     
-    history = []
-    converged = False
+    # Reynolds number for reference
+    Re_arr = np.where(velocity_arr > 0, (velocity_arr * diam_arr) / nu, 0.0)
     
-    for iteration in range(MAX_ITERATIONS):
-        max_correction = 0.0
-        iteration_log = {
-            "iteration": iteration + 1,
-            "loops": [],
-            "pipe_flows": {p_id: round(q, 6) for p_id, q in pipe_flows.items()}
+    # Round each quantity once for display
+    flows = np.round(Q_arr, 6).tolist()
+    forward = (Q_arr >= 0).tolist()
+    velocities = np.round(velocity_arr, 4).tolist()
+    head_losses = np.round(head_loss_arr, 4).tolist()
+    reynolds = np.round(Re_arr, 0).tolist()
+    K_values = np.round(K_arr, 4).tolist()
+    
+    results = [
+        {
+            "pipe_id": pipe_ids[i],
+            "start_node": pipe.start_node,
+            "end_node": pipe.end_node,
+            "flow": flows[i],
+            "flow_direction": "start→end" if forward[i] else "end→start",
+            "velocity": velocities[i],
+            "head_loss": head_losses[i],
+            "reynolds": reynolds[i],
+            "K": K_values[i],
+            "K_source": get_k_source(pipe)
         }
-        
-        # Process each loop
-        for loop_idx, loop_nodes in enumerate(loops):
-            sum_head_loss = 0.0
-            sum_derivative = 0.0
-            loop_pipe_info = []  # Track pipes in this loop for correction
-            
-            # Traverse the loop (node sequence)
-            num_nodes = len(loop_nodes)
-            for i in range(num_nodes):
-                node_u = loop_nodes[i]
-                node_v = loop_nodes[(i + 1) % num_nodes]
-                
-                # Get pipe connecting these nodes
-                edge_data = G.get_edge_data(node_u, node_v)
-                if edge_data is None:
+        for i, pipe in enumerate(pipe_list)
+    ]
+    return results
+
+def solve_network_batch(scenarios: List[NetworkInput]) -> List[dict]:
+    """
+    Solve several variants of one network together (e.g. demand sweeps).
+    
+    Scenarios that solve_network would send to the Newton solver (see
+    loop_solver) and that share the pipe layout of the first such one are
+    solved with newton_iterate_batch in a single run; each may have its own
+    demands, pipe properties and fluid. Everything else (puzzles, requests
+    for history, Hardy Cross, trees, disconnected networks and other
+    layouts) goes through solve_network one by one, so every scenario gets
+    the result a separate /solve would give. Returns one solve_network-style
+    result per scenario, in order.
+    """
+    responses: List[Optional[dict]] = [None] * len(scenarios)
+    batch = []  # (position, request, validated nodes, validated pipes)
+    layout = topology = None
+    for i, data in enumerate(scenarios):
+        if data.method != "puzzle" and not data.include_history:
+            nodes, pipes = validate_and_fix_network(data.nodes, data.pipes, method=data.method)
+            key = topology_key(pipes)
+            if layout is None or key == layout:
+                candidate = get_network_topology(pipes)
+                if (candidate.connected and candidate.loops
+                        and loop_solver(data, len(candidate.loops)) == "newton"):
+                    layout, topology = key, candidate
+                    batch.append((i, data, nodes, pipes))
                     continue
-                    
-                pipe_id = edge_data['id']
-                pipe_def = pipes_map[pipe_id]
-                K = pipe_K[pipe_id]
-                Q = pipe_flows[pipe_id]
-                
-                # Determine loop direction factor
-                # If we traverse u->v and pipe is defined start_node->end_node:
-                #   - If start_node == u: we're going WITH the pipe definition, factor = +1
-                #   - If start_node == v: we're going AGAINST the pipe definition, factor = -1
-                if pipe_def.start_node == node_u:
-                    loop_direction = 1.0
-                else:
-                    loop_direction = -1.0
-                
-                # Flow relative to loop traversal direction
-                Q_loop = Q * loop_direction
-                
-                # Head loss in loop direction (Darcy-Weisbach: h = K·Q·|Q|)
-                h_f = calculate_head_loss(K, Q_loop)
-                
-                # Derivative for Newton-Raphson correction
-                dh_dQ = calculate_head_loss_derivative(K, Q_loop)
-                
-                sum_head_loss += h_f
-                sum_derivative += dh_dQ
-                
-                loop_pipe_info.append({
-                    "pipe_id": pipe_id,
-                    "loop_direction": loop_direction,
-                    "Q": Q,
-                    "Q_loop": Q_loop,
-                    "h_f": h_f
-                })
-            
-            # Calculate flow correction (Hardy Cross formula)
-            if sum_derivative > 1e-12:
-                delta_Q = -sum_head_loss / sum_derivative
-            else:
-                delta_Q = 0.0
-            
-            # Track maximum correction for convergence check
-            if abs(delta_Q) > max_correction:
-                max_correction = abs(delta_Q)
-            
-            # Apply correction to all pipes in the loop
-            for pipe_info in loop_pipe_info:
-                pipe_id = pipe_info["pipe_id"]
-                loop_dir = pipe_info["loop_direction"]
-                
-                # Correction is applied considering loop direction
-                # If we traverse in same direction as pipe definition: add delta_Q
-                # If opposite: subtract delta_Q (multiply by loop_direction)
-                pipe_flows[pipe_id] += delta_Q * loop_dir
-            
-            iteration_log["loops"].append({
-                "loop_index": loop_idx + 1,
-                "nodes": loop_nodes,
-                "sum_head_loss": round(sum_head_loss, 6),
-                "sum_derivative": round(sum_derivative, 6),
-                "delta_Q": round(delta_Q, 6)
-            })
+        responses[i] = solve_network(data)
+    
+    if batch:
+        pid_to_idx = topology.pid_to_idx
+        pipe_ids = list(pid_to_idx)
+        prepared = []
+        for i, data, nodes, pipes in batch:
+            pipe_list, K_arr, diam_arr = build_pipe_arrays(pipes, pid_to_idx)
+            Q_arr = initial_flow_array(nodes, pipes, pipe_list, pid_to_idx)
+            prepared.append((pipe_list, K_arr, diam_arr, Q_arr))
         
-        iteration_log["max_correction"] = round(max_correction, 8)
-        history.append(iteration_log)
+        print(f"📊 Solving {len(batch)} scenario(s) with {len(topology.loops)} loop(s) each")
+        Q_batch, max_correction, iterations = newton_iterate_batch(
+            np.stack([K for _, K, _, _ in prepared]), np.stack([Q for _, _, _, Q in prepared]),
+            topology.loop_pipe_idx, topology.loop_dir, topology.loop_starts,
+            MAX_ITERATIONS, TOLERANCE, jacobian_pattern=topology.jacobian_pattern
+        )
         
-        # Check convergence
-        if max_correction < TOLERANCE:
-            converged = True
-            print(f"✅ Converged after {iteration + 1} iterations (max ΔQ = {max_correction:.2e})")
-            break
+        for b, ((i, data, _, _), (pipe_list, K_arr, diam_arr, _)) in enumerate(zip(batch, prepared)):
+            nu = data.fluid.viscosity if data.fluid else KINEMATIC_VISCOSITY
+            responses[i] = {
+                "converged": bool(max_correction[b] < TOLERANCE),
+                "iterations": int(iterations[b]),
+                "results": build_pipe_results(pipe_ids, pipe_list, K_arr, diam_arr, Q_batch[b], nu),
+                "history": []
+            }
     
-    if not converged:
-        print(f"⚠️ Did not converge after {MAX_ITERATIONS} iterations (max ΔQ = {max_correction:.2e})")
+    return responses
 
-    # 5. COMPUTE FINAL RESULTS
-    results = []
+def warm_up_solver():
+    """
+    Run each loop solver once on a one-loop network.
     
-    # Use fluid properties from input or defaults
-    nu = data.fluid.viscosity if data.fluid else KINEMATIC_VISCOSITY
+    The Numba kernels are compiled (or loaded from the on-disk cache in
+    NUMBA_CACHE_DIR) at import, but the parallel kernel only starts its
+    thread pool, and NumPy its LAPACK solver, on first use. Called at server
+    startup so that cost is not paid by the first /solve request.
+    """
+    K_arr = np.ones(3)
+    Q_init = np.array([1.0, -0.5, 0.25])
+    loop_pipe_idx = np.array([0, 1, 2], dtype=np.int32)
+    loop_dir = np.array([1, 1, -1], dtype=np.int8)
+    loop_starts = np.array([0, 3], dtype=np.int32)
+    loop_order = np.array([0], dtype=np.int32)
+    color_starts = np.array([0, 1], dtype=np.int32)
+    history = (np.zeros((1, 0)), np.zeros((1, 1)), np.zeros((1, 1)), np.zeros((1, 1)), np.zeros(1))
     
-    for pipe_id, Q in pipe_flows.items():
-        pipe = pipes_map[pipe_id]
-        K = pipe_K[pipe_id]
-        
-        # Velocity: V = Q / A = 4Q / (πD²)
-        velocity = (4.0 * abs(Q)) / (PI * pipe.diameter**2)
-        
-        # Head loss (absolute value for magnitude)
-        head_loss = abs(calculate_head_loss(K, Q))
-        
-        # Reynolds number for reference
-        Re = (velocity * pipe.diameter) / nu if velocity > 0 else 0
-        
-        results.append({
-            "pipe_id": pipe_id,
-            "start_node": pipe.start_node,
-            "end_node": pipe.end_node,
-            "flow": round(Q, 6),
-            "flow_direction": "start→end" if Q >= 0 else "end→start",
-            "velocity": round(velocity, 4),
-            "head_loss": round(head_loss, 4),
-            "reynolds": round(Re, 0),
-            "K": round(K, 4),
-            "K_source": get_k_source(pipe)
-        })
-
-    return {
-        "converged": converged,
-        "iterations": len(history),
-        "results": results,
-        "history": history
-    }
+    hardy_cross_iterate(K_arr, Q_init.copy(), loop_pipe_idx, loop_dir, loop_starts,
+                        MAX_ITERATIONS, TOLERANCE, False, *history)
+    iterate = hardy_cross_iterate_parallel if NUMBA_AVAILABLE else hardy_cross_iterate_numpy
+    iterate(K_arr, Q_init.copy(), loop_pipe_idx, loop_dir, loop_starts, loop_order, color_starts,
+            MAX_ITERATIONS, TOLERANCE, False, *history)
+    newton_iterate(K_arr, Q_init.copy(), loop_pipe_idx, loop_dir, loop_starts,
+                   MAX_ITERATIONS, TOLERANCE, False, *history)
 
 @app.post("/solve")
 async def solve_endpoint(data: NetworkInput):
@@ -633,11 +1621,19 @@ async def solve_endpoint(data: NetworkInput):
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/solve_batch")
+async def solve_batch_endpoint(data: List[NetworkInput]):
+    try:
+        return solve_network_batch(data)
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/initialize")
 async def initialize_endpoint(data: NetworkInput):
     try:
         # Validate first
-        nodes, pipes = validate_and_fix_network(data.nodes.copy(), data.pipes.copy(), method=data.method)
+        nodes, pipes = validate_and_fix_network(data.nodes, data.pipes, method=data.method)
         
         # Calculate initial flows
         initial_flows = initialize_flows_robust(nodes, pipes)
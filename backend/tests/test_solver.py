@@ -0,0 +1,249 @@
+import random
+
+import numpy as np
+import pytest
+
+import main
+
+
+def grid(rows, cols, seed=0, sinks=3):
+    """A rows x cols grid network fed at one corner, with a few random sinks."""
+    rnd = random.Random(seed)
+    node_ids = [f"N{i}_{j}" for i in range(rows) for j in range(cols)]
+    pipes = []
+    for i in range(rows):
+        for j in range(cols):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di < rows and j + dj < cols:
+                    pipes.append(dict(
+                        id=f"P{len(pipes)}", start_node=f"N{i}_{j}", end_node=f"N{i + di}_{j + dj}",
+                        length=rnd.uniform(50, 800), diameter=rnd.uniform(0.1, 0.3), roughness=0.02
+                    ))
+    demand = dict.fromkeys(node_ids, 0.0)
+    demand[node_ids[0]] = -0.2
+    for node_id in rnd.sample(node_ids[1:], sinks):
+        demand[node_id] += 0.2 / sinks
+    return dict(nodes=[dict(id=n, demand=d) for n, d in demand.items()], pipes=pipes)
+
+
+def solve(net, **options):
+    return main.solve_network(main.NetworkInput(**dict(net, **options)))
+
+
+def flows(result):
+    return {r["pipe_id"]: r["flow"] for r in result["results"]}
+
+
+def assert_same_flows(a, b, tol=1e-4):
+    fa, fb = flows(a), flows(b)
+    assert fa.keys() == fb.keys()
+    for pid in fa:
+        assert fa[pid] == pytest.approx(fb[pid], abs=tol), pid
+
+
+def kernel_inputs(net):
+    """Validated arrays and topology for calling the loop kernels directly."""
+    data = main.NetworkInput(**net)
+    nodes, pipes = main.validate_and_fix_network(data.nodes, data.pipes)
+    topology = main.build_network_topology(pipes)
+    pipe_list, K_arr, _ = main.build_pipe_arrays(pipes, topology.pid_to_idx)
+    Q_arr = main.initial_flow_array(nodes, pipes, pipe_list, topology.pid_to_idx)
+    return topology, K_arr, Q_arr
+
+
+def history_buffers(n_loops):
+    return np.zeros((1, 0)), np.zeros((1, n_loops)), np.zeros((1, n_loops)), np.zeros((1, n_loops)), np.zeros(1)
+
+
+# --- NEWTON SOLVER ---
+
+@pytest.mark.parametrize("rows, cols", [(4, 4), (5, 6)])
+def test_newton_matches_hardy_cross(rows, cols):
+    net = grid(rows, cols, seed=rows * cols)
+    serial = solve(net, solver="hardy_cross")
+    newton = solve(net, solver="newton")
+    assert serial["converged"] and newton["converged"]
+    assert newton["iterations"] < serial["iterations"]
+    assert_same_flows(newton, serial)
+
+
+def test_auto_solver_switches_at_threshold():
+    data = main.NetworkInput(**grid(2, 2))
+    assert main.loop_solver(data, main.NEWTON_LOOP_THRESHOLD - 1) == "hardy_cross"
+    assert main.loop_solver(data, main.NEWTON_LOOP_THRESHOLD) == "newton"
+    forced = data.model_copy(update={"solver": "hardy_cross"})
+    assert main.loop_solver(forced, main.NEWTON_LOOP_THRESHOLD) == "hardy_cross"
+
+    small = grid(4, 4, seed=1)  # 9 loops
+    assert solve(small) == solve(small, solver="hardy_cross")
+    large = grid(5, 6, seed=2)  # 20 loops
+    assert solve(large) == solve(large, solver="newton")
+
+
+def test_solve_newton_step_skips_singular_directions():
+    J = np.array([[2.0, 0.0], [0.0, 0.0]])
+    assert main.solve_newton_step(J, np.array([4.0, 0.0])) == pytest.approx([2.0, 0.0])
+
+
+def test_newton_survives_frictionless_loops():
+    # Outside darcy mode zero roughness is kept, so J is singular
+    net = grid(6, 6, seed=3, sinks=3)
+    for p in net["pipes"]:
+        p["roughness"] = 0.0
+    newton = solve(net, method="manual", solver="newton")
+    serial = solve(net, method="manual", solver="hardy_cross")
+    assert newton["converged"]
+    assert all(np.isfinite(list(flows(newton).values())))
+    assert_same_flows(newton, serial)
+
+
+# --- PARALLEL KERNELS ---
+
+def test_loop_colors_share_no_pipes():
+    topology, _, _ = kernel_inputs(grid(10, 10))
+    assert len(topology.loops) >= main.PARALLEL_LOOP_THRESHOLD
+    assert topology.loop_order is not None
+
+    starts = topology.loop_starts
+    for c in range(len(topology.color_starts) - 1):
+        seen = set()
+        for l in topology.loop_order[topology.color_starts[c]:topology.color_starts[c + 1]]:
+            pipes = set(topology.loop_pipe_idx[starts[l]:starts[l + 1]].tolist())
+            assert not pipes & seen
+            seen |= pipes
+
+
+def test_parallel_kernels_match_serial():
+    topology, K_arr, Q_init = kernel_inputs(grid(10, 10, seed=4))
+    csr = (topology.loop_pipe_idx, topology.loop_dir, topology.loop_starts)
+    groups = (topology.loop_order, topology.color_starts)
+    n_loops = len(topology.loops)
+    max_iter = 20 * main.MAX_ITERATIONS  # plain sweeps converge slowly on grids this size
+
+    Q_serial, correction, _ = main.hardy_cross_iterate(
+        K_arr, Q_init.copy(), *csr, max_iter, main.TOLERANCE, False, *history_buffers(n_loops)
+    )
+    assert correction < main.TOLERANCE
+
+    kernels = [main.hardy_cross_iterate_numpy]
+    if main.NUMBA_AVAILABLE:
+        kernels.append(main.hardy_cross_iterate_parallel)
+    for kernel in kernels:
+        Q_arr, correction, _ = kernel(
+            K_arr, Q_init.copy(), *csr, *groups, max_iter, main.TOLERANCE, False,
+            *history_buffers(n_loops)
+        )
+        assert correction < main.TOLERANCE
+        assert Q_arr == pytest.approx(Q_serial, abs=1e-4)
+
+
+# --- TOPOLOGY CACHE ---
+
+def test_topology_cache_reuses_layout():
+    main._topology_cache.clear()
+    net = grid(3, 3)
+    topology = main.get_network_topology(main.NetworkInput(**net).pipes)
+
+    edited = grid(3, 3, seed=5)  # same layout, other lengths, diameters and demands
+    assert main.get_network_topology(main.NetworkInput(**edited).pipes) is topology
+
+    net["pipes"][0]["end_node"] = "N2_2"
+    assert main.get_network_topology(main.NetworkInput(**net).pipes) is not topology
+
+
+def test_topology_cache_evicts_least_recently_used():
+    main._topology_cache.clear()
+    layouts = [main.NetworkInput(**grid(2, k + 2)).pipes for k in range(main.TOPOLOGY_CACHE_SIZE + 1)]
+    first = main.get_network_topology(layouts[0])
+    for pipes in layouts[1:]:
+        main.get_network_topology(pipes)
+    assert len(main._topology_cache) == main.TOPOLOGY_CACHE_SIZE
+    assert main.topology_key(layouts[0]) not in main._topology_cache
+    assert main.get_network_topology(layouts[0]) is not first
+
+
+# --- BATCH SOLVES ---
+
+def test_batch_matches_single_solves():
+    large = grid(5, 6, seed=6)
+    variant = dict(large, nodes=[dict(n, demand=n["demand"] * 0.5) for n in large["nodes"]])
+    small = grid(3, 3, seed=7)
+    tree = dict(nodes=[dict(id="A", demand=-1.0), dict(id="B", demand=1.0)],
+                pipes=[dict(id="p", start_node="A", end_node="B")])
+    disconnected = dict(nodes=[dict(id=x, demand=0.0) for x in "ABCD"],
+                        pipes=[dict(id="a", start_node="A", end_node="B"), dict(id="b", start_node="C", end_node="D")])
+    puzzle = dict(method="puzzle", nodes=[dict(id="A", demand=5.0), dict(id="B")],
+                  pipes=[dict(id="AB", start_node="A", end_node="B", given_flow=5.0, given_head_loss=2.0)])
+    scenarios = [main.NetworkInput(**net) for net in (
+        small, large, tree, puzzle, variant, disconnected, dict(large, include_history=True),
+        dict(large, solver="hardy_cross"), dict(small, solver="newton"), grid(6, 5, seed=8),
+    )]
+
+    batch = main.solve_network_batch(scenarios)
+    assert batch == [main.solve_network(s) for s in scenarios]
+
+
+def test_batch_survives_singular_scenario():
+    net = grid(6, 6, seed=9)
+    frictionless = dict(net, pipes=[dict(p, roughness=0.0) for p in net["pipes"]])
+    scenarios = [main.NetworkInput(**n, method="manual", solver="newton") for n in (net, frictionless, net)]
+
+    batch = main.solve_network_batch(scenarios)
+    assert batch == [main.solve_network(s) for s in scenarios]
+    assert all(r["converged"] for r in batch)
+
+
+def test_batch_of_nothing():
+    assert main.solve_network_batch([]) == []
+
+
+# --- EDGE CASES ---
+
+def test_tree_network():
+    net = dict(nodes=[dict(id="A", demand=-1.0), dict(id="B", demand=0.5), dict(id="C", demand=0.5)],
+               pipes=[dict(id="a", start_node="A", end_node="B"), dict(id="b", start_node="B", end_node="C")])
+    for solver in ("auto", "hardy_cross", "newton"):
+        result = solve(net, solver=solver, include_history=True)
+        assert result["converged"] and result["iterations"] == 1
+        assert result["history"] == [{"iteration": 1, "loops": [], "max_correction": 0.0}]
+        assert abs(flows(result)["a"]) == pytest.approx(1.0)
+        assert abs(flows(result)["b"]) == pytest.approx(0.5)
+
+
+def test_disconnected_network():
+    net = dict(nodes=[dict(id=x, demand=0.0) for x in "ABCD"],
+               pipes=[dict(id="a", start_node="A", end_node="B"), dict(id="b", start_node="C", end_node="D")])
+    assert "error" in solve(net)
+
+
+# --- PUZZLE LINEAR SOLVE ---
+
+def test_solve_determined_unknowns():
+    # x0 + x1 = 2 leaves x0 and x1 open; x2 = 3 is determined
+    assert main.solve_determined_unknowns([{0: 1.0, 1: 1.0}, {2: 1.0}], [2.0, 3.0], 3) == {2: pytest.approx(3.0)}
+    assert main.solve_determined_unknowns([{0: 1.0}, {0: 1.0}], [1.0, 2.0], 1) is None
+    assert main.solve_determined_unknowns([{}], [0.5], 0) is None
+
+
+def puzzle(hl_ab=2.0, hl_bc=1.0, hl_ac=None):
+    pipes = [dict(id="AB", start_node="A", end_node="B", given_flow=5.0, given_head_loss=hl_ab),
+             dict(id="BC", start_node="B", end_node="C", given_head_loss=hl_bc),
+             dict(id="AC", start_node="A", end_node="C", given_flow=3.0, given_head_loss=hl_ac)]
+    nodes = [dict(id="A", demand=8.0), dict(id="B"), dict(id="C", demand=-8.0)]
+    return dict(method="puzzle", pipes=pipes, nodes=nodes)
+
+
+def test_puzzle_solves_consistent_data():
+    result = solve(puzzle())
+    by_pipe = {r["pipe_id"]: r for r in result["results"]}
+    assert by_pipe["BC"]["flow"] == 5.0
+    assert by_pipe["AC"]["head_loss"] == 3.0
+    assert {n["node_id"]: n["demand"] for n in result["node_results"]}["B"] == 0.0
+
+
+def test_puzzle_tolerates_rounded_data():
+    assert "error" not in solve(puzzle(hl_ab=1.11, hl_bc=2.22, hl_ac=3.34))
+
+
+def test_puzzle_reports_contradictory_data():
+    assert "error" in solve(puzzle(hl_ab=4.0, hl_bc=1.0, hl_ac=3.0))
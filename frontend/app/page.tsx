@@ -182,6 +182,7 @@ export default function Home() {
 			nodes,
 			pipes,
 			fluid,
+			include_history: true, // The tutorial walks through every iteration
 		};
 
 		try {